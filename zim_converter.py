@@ -1,24 +1,15 @@
 import os
 import sqlite3
-import zstd
+import zstandard
 import argparse
+from collections import deque
 from libzim import Archive
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-
-def merge_databases(db1: str, db2: str):
-    """Merges all entries from db2 into db1
-    """
-    con3 = sqlite3.connect(db1)
-    print("merging:", db2)
-    con3.execute("ATTACH '" + db2 + "' as dba")
-
-    con3.execute("BEGIN")
-    for row in con3.execute("SELECT * FROM dba.sqlite_master WHERE type='table'"):
-        combine = "INSERT OR IGNORE INTO " + row[1] + " SELECT * FROM dba." + row[1]
-        con3.execute(combine)
-    con3.commit()
-    con3.execute("detach database dba")
+# Created once per worker process by init_worker and reused for every range
+zim_archive = None
+zstd_compressor = None
 
 
 def setup_db(con):
@@ -27,7 +18,14 @@ def setup_db(con):
     cursor = con.cursor()
 
     cursor.executescript("""
-    PRAGMA journal_mode=DELETE;
+    PRAGMA page_size=32768;
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-262144;
+    PRAGMA mmap_size=1073741824;
+    PRAGMA wal_autocheckpoint=12500;
+    PRAGMA journal_size_limit=536870912;
 
     CREATE TABLE IF NOT EXISTS articles (
         id INTEGER PRIMARY KEY,
@@ -38,94 +36,142 @@ def setup_db(con):
     CREATE TABLE IF NOT EXISTS title_2_id  (
         id INTEGER NOT NULL,
         title_lower_case TEXT PRIMARY KEY
-    );
+    ) WITHOUT ROWID;
 
     DROP TABLE IF EXISTS css;
     CREATE TABLE IF NOT EXISTS css  (
         content_zstd BLOB NOT NULL
     );
 
+    DROP TABLE IF EXISTS zstd_dict;
+    CREATE TABLE IF NOT EXISTS zstd_dict  (
+        dict_data BLOB NOT NULL
+    );
+
     """)
     con.commit()
 
 
-def process_range(args):
-    """Process a range of a ZIM file into a seperate SQLite database"""
-    start_id, end_id, zim_path, db_path = args
-
-    con = sqlite3.connect(db_path)
+def insert_rows(con, title_rows: list, article_rows: list):
+    """Write the rows of a processed range in one transaction with one executemany per table
+    """
     cursor = con.cursor()
-    setup_db(con)
-
+    cursor.execute("BEGIN")
+    cursor.executemany("""
+        INSERT INTO title_2_id VALUES(?, ?)
+        ON CONFLICT(title_lower_case) DO UPDATE SET id = excluded.id WHERE id != excluded.id
+    """, title_rows)
+    cursor.executemany("INSERT OR REPLACE INTO articles VALUES(?, ?, ?)", article_rows)
+    cursor.execute("COMMIT")
+
+
+def train_dictionary(zim_path: str, compression_level=3, num_samples=1000, dict_size=110_000):
+    """Train a zstd dictionary on articles spread over the ZIM file,
+    raises a ValueError when the ZIM file has too little article data to train on
+    """
     zim = Archive(zim_path)
+    step = max(zim.entry_count // num_samples, 1)
+    samples = []
+    id = 0
+    for start_id in range(0, zim.entry_count, step):
+        # When the sampled id is a special file or redirect, take the next article instead
+        id = max(id, start_id)
+        while id < zim.entry_count:
+            zim_entry = zim._get_entry_by_id(id)
+            id += 1
+            if not zim_entry.path.startswith('-') and not zim_entry.is_redirect:
+                samples.append(bytes(zim_entry.get_item().content))
+                break
+
+    error = f'--train-dictionary needs more article data than the {len(samples)} articles found in {zim_path}'
+    if sum(len(sample) for sample in samples) < dict_size:
+        raise ValueError(error)
+    try:
+        dict_data = zstandard.train_dictionary(dict_size, samples, level=compression_level).as_bytes()
+    except zstandard.ZstdError as e:
+        raise ValueError(f'{error}: {e}')
+    print(f'Trained a {len(dict_data)} byte dictionary on {len(samples)} articles')
+    return dict_data
+
+
+def init_worker(zim_path: str, compression_level=3, dict_data=None):
+    """Open the ZIM file and create the compressor once per process instead of once per range"""
+    global zim_archive, zstd_compressor
+    zim_archive = Archive(zim_path)
+    if dict_data is not None:
+        dict_data = zstandard.ZstdCompressionDict(dict_data)
+    zstd_compressor = zstandard.ZstdCompressor(level=compression_level, dict_data=dict_data)
+
+
+def process_range(args):
+    """Process a range of entries of the ZIM file opened by init_worker into database rows"""
+    start_id, end_id = args
+
+    title_rows = []
+    article_rows = []
+    # Look up the globals and bound methods once per range instead of once per entry
+    get_entry_by_id = zim_archive._get_entry_by_id
+    compress = zstd_compressor.compress
     for id in range(start_id, end_id):
-        zim_entry = zim._get_entry_by_id(id)
+        zim_entry = get_entry_by_id(id)
 
-        # Detect special files
+        # Skip special files, CSS extraction is disabled for now
         if zim_entry.path.startswith('-'):
-            if zim_entry.title.endswith(".css") and False:  # Disabled for now
-                css_content = bytes(zim_entry.get_item().content)
-                css = css_content
-                cursor.execute("UPDATE css SET content_zstd = ?", [zstd.compress(css)])
-
-            # Don't continue parsing them as articles
             continue
 
         # deal with normal files
+        title = zim_entry.title
         if zim_entry.is_redirect:
             destination_entry = zim_entry.get_redirect_entry()
-            cursor.execute("INSERT OR REPLACE INTO title_2_id VALUES(?, ?)", [
-                destination_entry._index, zim_entry.title.lower()
-            ])
+            title_rows.append((destination_entry._index, title.lower()))
         else:  # It is a proper article
             # First make it findable
-            cursor.execute("INSERT OR REPLACE INTO title_2_id VALUES(?, ?)", [
-                zim_entry._index, zim_entry.title.lower()
-            ])
-
-            page_content = bytes(zim_entry.get_item().content)
-            zstd_page_content = zstd.compress(page_content)
-            cursor.execute("INSERT OR REPLACE INTO articles VALUES(?, ?, ?)", [
-                zim_entry._index, zim_entry.title.replace("_", " "), zstd_page_content
-            ])
-        # Commit to db on disk every once in a while
-        if id % 10000 == 0:
-            print(f'Commiting batch to db, at i {id} of {end_id}')
-            con.commit()
+            title_rows.append((zim_entry._index, title.lower()))
+
+            # The memoryview from libzim is compressed directly, no need to copy it into bytes first
+            zstd_page_content = compress(zim_entry.get_item().content)
+            article_rows.append((zim_entry._index, title.replace("_", " "), zstd_page_content))
 
-    con.commit()
-    con.close()
     print('Done with batch, at id:', start_id, end_id)
-    return args
+    return title_rows, article_rows
 
 
-def convert_multithreaded(args, num_cores=None):
-    # Create jobs for the job pool
-    zim = Archive(args.zim_file)
-    batch_size = 5000
+def create_tasks(zim_path: str, batch_size=5000):
+    """Split the entries of a ZIM file into disjoint id ranges"""
+    zim = Archive(zim_path)
     end = zim.entry_count
+    return [(start_i, min(start_i + batch_size, end)) for start_i in range(0, end, batch_size)]
+
+
+def imap_bounded(pool, func, tasks, max_pending: int):
+    """Like pool.imap, but keeps at most max_pending results waiting for the writer
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
-    tasks = [(start_i,
-             min(start_i + batch_size + 1, end),
-             args.zim_file, args.output_db+f'_{start_i}'
-              ) for start_i in range(0, end, batch_size)
-             ]
 
+def convert_multithreaded(con, args, num_cores=None, dict_data=None):
+    # Create jobs for the job pool
+    tasks = create_tasks(args.zim_file)
     print("Created tasks")
 
-    # Process jobs with pool
-    with Pool(num_cores) as pool:
-        results = pool.imap(process_range, tasks)
-        for task in results:
-            _, _, _, db_path = task
-            merge_databases(args.output_db, db_path)
-            os.remove(db_path)  # Delete temp db file after done merging
+    # Process jobs with pool, only this process writes to the database
+    max_pending = 2 * (num_cores or os.cpu_count())
+    with Pool(num_cores, initializer=init_worker, initargs=(args.zim_file, args.compression_level, dict_data)) as pool:
+        for title_rows, article_rows in imap_bounded(pool, process_range, tasks, max_pending):
+            insert_rows(con, title_rows, article_rows)
 
 
-def convert_singlethreaded(args):
-    zim = Archive(args.zim_file)
-    task = (0, zim.entry_count, args.zim_file, args.output_db)
-    process_range(task)
+def convert_singlethreaded(con, args, dict_data=None):
+    # A single reader thread prepares the next range while this thread writes the previous one
+    with ThreadPool(1, initializer=init_worker, initargs=(args.zim_file, args.compression_level, dict_data)) as pool:
+        for title_rows, article_rows in imap_bounded(pool, process_range, create_tasks(args.zim_file), 2):
+            insert_rows(con, title_rows, article_rows)
 
 
 if __name__ == "__main__":
@@ -139,23 +185,52 @@ if __name__ == "__main__":
         default="./zim_articles.db"
     )
     parser.add_argument(
-        '--num-cores', help='Number of cores used for conversion, default is single threaded',
+        '--num-cores', help='Number of cores used for conversion, 0 uses all cores, default is single threaded',
         default=1,
         type=int
     )
+    parser.add_argument(
+        '--compression-level', help='zstd compression level of the articles, higher is smaller but slower',
+        default=3,
+        type=int
+    )
+    parser.add_argument(
+        '--train-dictionary', help='Compress articles with a zstd dictionary trained on the ZIM file, '
+                                   'it is stored in the zstd_dict table and the reader needs it to decompress',
+        action='store_true'
+    )
     args = parser.parse_args()
-
-    # Setup db connection
+    if args.num_cores == 0:
+        args.num_cores = os.cpu_count()
+    # Checked here, an invalid level would otherwise make every pool worker fail in init_worker
+    if args.compression_level > zstandard.MAX_COMPRESSION_LEVEL:
+        parser.error(f'--compression-level must be at most {zstandard.MAX_COMPRESSION_LEVEL}')
+
+    # Train before touching the output db, so a failure doesn't leave a half-initialised database
+    dict_data = None
+    if args.train_dictionary:
+        try:
+            dict_data = train_dictionary(args.zim_file, args.compression_level)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # Setup db connection, transactions are managed explicitly in insert_rows
     processed_ids = {}
-    con = sqlite3.connect(args.output_db)
+    con = sqlite3.connect(args.output_db, isolation_level=None)
     cursor = con.cursor()
     setup_db(con)
+    if dict_data is not None:
+        con.execute("INSERT INTO zstd_dict VALUES(?)", [dict_data])
 
     # Now perform the jobs single or multithreaded
     print(f'Starting conversion with {args.num_cores} cores')
     if args.num_cores == 1:
-        convert_singlethreaded(args)
+        convert_singlethreaded(con, args, dict_data)
     else:
-        convert_multithreaded(args, args.num_cores)
+        convert_multithreaded(con, args, args.num_cores, dict_data)
 
+    # WAL is only used while converting, WikiReader expects a single self-contained file
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    con.execute("PRAGMA journal_mode=DELETE")
+    con.close()
     print('Done')